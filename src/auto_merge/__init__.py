@@ -3,6 +3,8 @@ import logging
 import os
 import sys
 
+from github import Auth, Github
+
 from auto_merge import check_pr, merge
 from auto_merge.config import load_config
 
@@ -39,13 +41,14 @@ def main():
         parser.print_usage()
         sys.exit(1)
 
-    kwargs = dict(args._get_kwargs())
-    del kwargs["func"]
+    kwargs = {k: v for k, v in vars(args).items() if k != "func"}
     kwargs["config"] = load_config()
     try:
         kwargs["github_access_token"] = os.environ["GH_TOKEN"]
     except KeyError:
         raise Exception("Missing `GH_TOKEN` environment variable.")
+    # One client for the whole run, so its HTTP connection is reused.
+    kwargs["gh"] = Github(auth=Auth.Token(kwargs["github_access_token"]))
     if func == merge.run:
         try:
             kwargs["monitoring_review_url"] = os.environ[
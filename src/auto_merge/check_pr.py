@@ -1,14 +1,46 @@
-from github import Auth, Github
+from github import Github
+from github.Repository import Repository
+from gql import gql
 
 from auto_merge import utils
 from auto_merge.config import Config
 
 
-def check_pr(pr_id: int, github_access_token: str, config: Config):
-    gh = Github(auth=Auth.Token(github_access_token))
+def recent_comments(repository: Repository, pr_id: int, token: str) -> set[str]:
+    """Bodies of the last 100 comments of a PR, fetched with one GraphQL
+    request instead of paging through all of them."""
+    client = utils.graphql_client(token)
+    query = gql(
+        """
+        query ($owner: String!, $name: String!, $number: Int!) {
+          repository(owner: $owner, name: $name) {
+            pullRequest(number: $number) {
+              comments(last: 100) {
+                nodes {
+                  body
+                }
+              }
+            }
+          }
+        }
+        """
+    )
+    result = client.execute(
+        query,
+        variable_values={
+            "owner": repository.owner.login,
+            "name": repository.name,
+            "number": pr_id,
+        },
+    )
+    comments = result["repository"]["pullRequest"]["comments"]["nodes"]
+    return {c["body"] for c in comments}
+
+
+def check_pr(pr_id: int, gh: Github, github_access_token: str, config: Config):
     repository = gh.get_repo(config.general.fc_nixos_repo_name)
 
-    pr = repository.get_pull(pr_id)
+    pr = utils.fetch_pr(repository, pr_id, github_access_token)
     risk, urgency = utils.get_label_values_for_pr(pr.labels)
     if risk is None or urgency is None:
         # This raises a runtime error, so it shows as a red check indicator in GitHub
@@ -16,13 +48,10 @@ def check_pr(pr_id: int, github_access_token: str, config: Config):
             "PR doesn't have risk and urgency labels. Not mergeable."
         )
     # check if PR is approved
-    mergeable = utils.check_pr_mergeable(
-        repository, pr, github_access_token, config
-    )
+    mergeable = utils.check_pr_mergeable(pr, config)
     if mergeable:
         merge_date = utils.calculate_merge_date(risk, urgency, config)
         msg = f"This PR is ready to merge. Merge scheduled for {merge_date.isoformat()}"
-        for comment in pr.get_issue_comments():
-            if comment.body == msg:
-                return
-        pr.create_issue_comment(msg)
+        if msg in recent_comments(repository, pr_id, github_access_token):
+            return
+        repository.get_pull(pr_id).create_issue_comment(msg)
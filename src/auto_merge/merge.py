@@ -1,15 +1,14 @@
 import datetime
 import json
 import logging
-import tempfile
 import zipfile
 from io import BytesIO
 from os import path
 from pathlib import Path
 
 import requests
-from git import Repo
-from github import Auth, Github
+from git import GitCommandError, Repo
+from github import Github
 
 from auto_merge import utils
 from auto_merge.config import Config
@@ -20,23 +19,21 @@ def merge_prs(config: Config, gh: Github, github_access_token: str):
     repo_name = config.general.fc_nixos_repo_name
     repo = gh.get_repo(repo_name)
     today = datetime.date.today()
-    for pr in repo.get_pulls(state="open"):
-        mergeable = utils.check_pr_mergeable(
-            repo, pr, github_access_token, config
-        )
+    for pr in utils.fetch_open_prs(repo, github_access_token):
+        mergeable = utils.check_pr_mergeable(pr, config)
         if not mergeable:
             logging.debug(
-                f"PR {pr.number} does not fulfill the merge criteria."
+                "PR %s does not fulfill the merge criteria.", pr.number
             )
             continue
         risk, urgency = utils.get_label_values_for_pr(pr.labels)
         merge_date = utils.calculate_merge_date(risk, urgency, config)
         if merge_date == today:
             logging.info(f"Merging PR {pr.number}.")
-            pr.merge(delete_branch=True)
+            repo.get_pull(pr.number).merge(delete_branch=True)
 
 
-def fc_nixos_repository(directory: str, url: str) -> Repo:
+def fc_nixos_repository(directory: str, url: str, config: Config) -> Repo:
     logging.info("Updating fc-nixos repository.")
     if path.exists(directory):
         repo = Repo(directory)
@@ -44,13 +41,37 @@ def fc_nixos_repository(directory: str, url: str) -> Repo:
         repo = Repo.init(directory, mkdir=True)
         repo.create_remote("origin", url)
 
-    repo.remotes["origin"].fetch()
+    # Only the branches merge_staging works on are needed. Blobs are fetched
+    # on demand when checking out and merging.
+    refspecs = [
+        f"+refs/heads/fc-{platform_version}-{stage}:refs/remotes/origin/fc-{platform_version}-{stage}"
+        for platform_version in config.general.platform_versions
+        for stage in ("dev", "staging")
+    ]
+    repo.remotes["origin"].fetch(refspec=refspecs, filter="blob:none")
     return repo
 
 
 def merge_staging(fc_nixos_repo: Repo, config: Config):
     for platform_version in config.general.platform_versions:
-        fc_nixos_repo.git.checkout(f"fc-{platform_version}-staging")
+        # Usually staging has no commits of its own and can be fast-forwarded
+        # on the remote directly, without touching the working tree.
+        try:
+            fc_nixos_repo.git.push(
+                "origin",
+                f"origin/fc-{platform_version}-dev:refs/heads/fc-{platform_version}-staging",
+            )
+            continue
+        except GitCommandError:
+            logging.info(
+                f"Cannot fast-forward fc-{platform_version}-staging, merging."
+            )
+        # A local branch from an earlier run may be behind the remote.
+        fc_nixos_repo.git.checkout(
+            "-B",
+            f"fc-{platform_version}-staging",
+            f"origin/fc-{platform_version}-staging",
+        )
         fc_nixos_repo.git.merge(
             f"origin/fc-{platform_version}-dev", no_edit=True
         )
@@ -93,34 +114,32 @@ def run(
     fc_nixos_dir: str,
     action_run_repo_name: str,
     config: Config,
+    gh: Github,
     github_access_token: str,
     monitoring_review_url: str,
     matrix_hookshot_url: str,
 ):
     matrix_hookshot = MatrixHookshot(matrix_hookshot_url)
-    gh = Github(auth=Auth.Token(github_access_token))
     action_run_repo = gh.get_repo(action_run_repo_name)
     try:
         runs = action_run_repo.get_workflow("auto-merge.yaml").get_runs(
             status="completed"
         )
-        download_url = ""
-        for artifact in runs[0].get_artifacts():
-            if artifact.name == "status-json":
-                download_url = artifact.archive_download_url
-                break
-        with tempfile.TemporaryDirectory() as tmpdir:
-            r = requests.get(
-                download_url,
-                headers={"Authorization": f"Bearer {github_access_token}"},
-            )
-            r.raise_for_status()
-            z = zipfile.ZipFile(BytesIO(r.content))
-            z.extractall(tmpdir)
-            status = json.load((Path(tmpdir) / "auto-merge-status.json").open())
-            logging.info(
-                f"Found auto-merge-status.json with contents: {json.dumps(status)}"
-            )
+        headers = {"Authorization": f"Bearer {github_access_token}"}
+        # Let GitHub filter the artifacts by name instead of paging through
+        # all of them.
+        r = requests.get(
+            runs[0].artifacts_url,
+            params={"name": "status-json", "per_page": 1},
+            headers=headers,
+        )
+        r.raise_for_status()
+        download_url = r.json()["artifacts"][0]["archive_download_url"]
+        r = requests.get(download_url, headers=headers)
+        r.raise_for_status()
+        with zipfile.ZipFile(BytesIO(r.content)) as z:
+            status = json.loads(z.read("auto-merge-status.json"))
+        logging.info("Found auto-merge-status.json with contents: %s", status)
     except Exception as e:
         logging.debug(
             "Error happened while fetching auto-merge-status.json: ", exc_info=e
@@ -139,7 +158,7 @@ def run(
         #     config, monitoring_review_url, matrix_hookshot
         # ):
         #     return
-        fc_nixos_repo = fc_nixos_repository(fc_nixos_dir, fc_nixos_url)
+        fc_nixos_repo = fc_nixos_repository(fc_nixos_dir, fc_nixos_url, config)
         merge_staging(fc_nixos_repo, config)
         status["last_staging_merge"] = datetime.datetime.now().isoformat()
 
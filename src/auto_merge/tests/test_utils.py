@@ -4,6 +4,7 @@ from unittest import mock
 from zoneinfo import ZoneInfo
 
 import pytest
+from dateutil import rrule
 
 from auto_merge.config import (
     Config,
@@ -12,10 +13,14 @@ from auto_merge.config import (
     PRMergeDayConfig,
 )
 from auto_merge.utils import (
+    PRInfo,
     calculate_merge_date,
+    check_pr_mergeable,
     convert_relative_day_to_date,
+    count_workdays,
     next_production_merge,
     now_relative_day,
+    nth_workday,
 )
 
 
@@ -197,3 +202,139 @@ def test_merge_date_is_always_in_future(config, now):
                 calculate_merge_date(risk=risk, urgency=urgency, config=config)
                 >= now.return_value.date()
             )
+
+
+def pr_node(checks=(), **fields):
+    """A pull request as returned by the PRFields GraphQL fragment."""
+    node = {
+        "number": 42,
+        "mergeable": "MERGEABLE",
+        "isDraft": False,
+        "baseRefName": "fc-24.11-dev",
+        "reviewDecision": "APPROVED",
+        "labels": {"nodes": [{"name": "risk:1"}, {"name": "urgency:3"}]},
+        "commits": {
+            "nodes": [
+                {
+                    "commit": {
+                        "statusCheckRollup": {
+                            "contexts": {"nodes": list(checks)}
+                        }
+                    }
+                }
+            ]
+        },
+    }
+    node.update(fields)
+    return node
+
+
+def test_pr_info_from_graphql():
+    pr = PRInfo.from_graphql(pr_node())
+    assert pr == PRInfo(
+        number=42,
+        mergeable=True,
+        draft=False,
+        base_ref="fc-24.11-dev",
+        labels=["risk:1", "urgency:3"],
+        review_decision="APPROVED",
+        failed_checks=[],
+    )
+    assert not PRInfo.from_graphql(pr_node(mergeable="CONFLICTING")).mergeable
+    assert not PRInfo.from_graphql(pr_node(mergeable="UNKNOWN")).mergeable
+
+
+def test_pr_info_failed_checks():
+    pr = PRInfo.from_graphql(
+        pr_node(
+            checks=[
+                {"name": "build", "conclusion": "SUCCESS"},
+                {"name": "lint", "conclusion": "FAILURE"},
+                {"name": "pending", "conclusion": None},
+                {"name": "skipped", "conclusion": "SKIPPED"},
+                {"name": "timeout", "conclusion": "TIMED_OUT"},
+                {"name": "deploy", "conclusion": "CANCELLED"},
+                {"context": "hydra", "state": "ERROR"},
+                {"context": "ci/legacy", "state": "SUCCESS"},
+                {"context": "ci/waiting", "state": "PENDING"},
+                # the check running this tool is still in progress
+                {
+                    "name": "check-auto-mergeability-of-pr",
+                    "conclusion": "FAILURE",
+                },
+            ]
+        )
+    )
+    assert pr.failed_checks == ["lint", "timeout", "deploy", "hydra"]
+
+
+def test_pr_info_without_checks():
+    node = pr_node()
+    node["commits"]["nodes"][0]["commit"]["statusCheckRollup"] = None
+    assert PRInfo.from_graphql(node).failed_checks == []
+    assert (
+        PRInfo.from_graphql(pr_node(commits={"nodes": []})).failed_checks == []
+    )
+
+
+def test_check_pr_mergeable(config):
+    assert check_pr_mergeable(PRInfo.from_graphql(pr_node()), config)
+    for node in [
+        pr_node(mergeable="CONFLICTING"),
+        pr_node(isDraft=True),
+        pr_node(baseRefName="fc-24.11-staging"),
+        pr_node(baseRefName="fc-24.05-dev"),
+        pr_node(checks=[{"name": "lint", "conclusion": "FAILURE"}]),
+    ]:
+        assert not check_pr_mergeable(PRInfo.from_graphql(node), config)
+
+
+def test_count_workdays():
+    # 2024-11-21 is a Thursday
+    thu = date(2024, 11, 21)
+    assert count_workdays(thu, thu) == 0
+    assert count_workdays(thu, date(2024, 11, 22)) == 1
+    assert count_workdays(thu, date(2024, 11, 24)) == 1
+    assert count_workdays(thu, date(2024, 11, 25)) == 2
+    assert count_workdays(thu, date(2024, 11, 28)) == 5
+    assert count_workdays(thu, date(2024, 12, 9)) == 12
+    # starting on a weekend
+    assert count_workdays(date(2024, 11, 23), date(2024, 11, 24)) == 0
+    assert count_workdays(date(2024, 11, 23), date(2024, 11, 25)) == 1
+    assert count_workdays(date(2024, 11, 24), date(2024, 12, 2)) == 6
+
+
+def test_nth_workday():
+    thu = date(2024, 11, 21)
+    assert nth_workday(thu, 0) == thu
+    assert nth_workday(thu, 1) == date(2024, 11, 22)
+    assert nth_workday(thu, 2) == date(2024, 11, 25)
+    assert nth_workday(thu, 5) == date(2024, 11, 28)
+    assert nth_workday(thu, 7) == date(2024, 12, 2)
+    assert nth_workday(thu, 11) == date(2024, 12, 6)
+    # starting on a weekend
+    assert nth_workday(date(2024, 11, 23), 0) == date(2024, 11, 25)
+    assert nth_workday(date(2024, 11, 24), 4) == date(2024, 11, 29)
+    assert nth_workday(date(2024, 11, 24), 5) == date(2024, 12, 2)
+    assert nth_workday(date(2024, 11, 23), 12) == date(2024, 12, 11)
+
+
+def test_workdays_match_rrule():
+    """Compare with the rrule based implementation these helpers replaced."""
+    for start in rrule.rrule(
+        rrule.DAILY, dtstart=datetime(2024, 11, 1), count=14
+    ):
+        for n in range(12):
+            expected = rrule.rrule(
+                rrule.DAILY, byweekday=(0, 1, 2, 3, 4), dtstart=start
+            )[n]
+            assert nth_workday(start.date(), n) == expected.date()
+        for end in rrule.rrule(rrule.DAILY, dtstart=start, count=22):
+            expected = sum(
+                1
+                for dt in rrule.rrule(
+                    rrule.DAILY, dtstart=start, until=end
+                ).xafter(start)
+                if dt.weekday() < 5
+            )
+            assert count_workdays(start.date(), end.date()) == expected
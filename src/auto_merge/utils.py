@@ -1,15 +1,11 @@
 import datetime
-import json
+import functools
 import logging
-import os
-import re
-import subprocess
+from dataclasses import dataclass
+from typing import Self
 from zoneinfo import ZoneInfo
 
-from dateutil import rrule
 from dateutil.relativedelta import relativedelta
-from github import Label
-from github.PullRequest import PullRequest
 from github.Repository import Repository
 from gql import Client, gql
 from gql.transport.requests import RequestsHTTPTransport
@@ -24,12 +20,16 @@ def now_tz():
     return datetime.datetime.now(tz=ZoneInfo("Europe/Berlin"))
 
 
-def last_production_merge(config: Config) -> datetime.datetime:
-    return next_production_merge(config) - datetime.timedelta(weeks=1)
+def last_production_merge(
+    config: Config, now: datetime.datetime | None = None
+) -> datetime.datetime:
+    return next_production_merge(config, now) - datetime.timedelta(weeks=1)
 
 
-def next_production_merge(config: Config) -> datetime.datetime:
-    now = now_tz()
+def next_production_merge(
+    config: Config, now: datetime.datetime | None = None
+) -> datetime.datetime:
+    now = now or now_tz()
     # In the week of the production merge, just need to add the difference in days
     if now.weekday() < config.general.production_merge_day:
         day = now + datetime.timedelta(
@@ -49,67 +49,230 @@ def next_production_merge(config: Config) -> datetime.datetime:
     )
 
 
-def now_relative_day(config: Config) -> int:
-    now = now_tz()
-    last_prod_merge_day = last_production_merge(config).replace(hour=0)
+def now_relative_day(
+    config: Config, now: datetime.datetime | None = None
+) -> int:
+    now = now or now_tz()
+    last_prod_merge_day = last_production_merge(config, now).replace(hour=0)
 
     # Calculate workdays between the last production merge and now
     # last production merge day = 0
-    workdays = 0
-    for dt in rrule.rrule(
-        rrule.DAILY, dtstart=last_prod_merge_day, until=now
-    ).xafter(last_prod_merge_day):
-        if dt.weekday() != 5 and dt.weekday() != 6:
-            workdays += 1
-
-    return workdays
+    return count_workdays(last_prod_merge_day.date(), now.date())
 
 
-def convert_relative_day_to_date(day: int, config: Config) -> datetime.date:
+def convert_relative_day_to_date(
+    day: int, config: Config, now: datetime.datetime | None = None
+) -> datetime.date:
+    now = now or now_tz()
     # We only want to return days in the future
     # These das are relative to the next production merge
-    if now_relative_day(config) <= day:
-        dt = rrule.rrule(
-            rrule.DAILY,
-            byweekday=(0, 1, 2, 3, 4),
-            dtstart=last_production_merge(config),
-        )[day]
-        return dt.date()
-    dt = rrule.rrule(
-        rrule.DAILY,
-        byweekday=(0, 1, 2, 3, 4),
-        dtstart=next_production_merge(config),
-    )[day]
-    return dt.date()
+    if now_relative_day(config, now) <= day:
+        return nth_workday(last_production_merge(config, now).date(), day)
+    return nth_workday(next_production_merge(config, now).date(), day)
+
+
+def count_workdays(start: datetime.date, end: datetime.date) -> int:
+    """Number of workdays after `start` up to and including `end`."""
+    full_weeks, rest = divmod((end - start).days, 7)
+    weekday = start.weekday()
+    return full_weeks * 5 + sum(
+        1 for i in range(1, rest + 1) if (weekday + i) % 7 < 5
+    )
+
+
+def nth_workday(start: datetime.date, n: int) -> datetime.date:
+    """The n-th workday on or after `start`, counting from 0."""
+    full_weeks, rest = divmod(n, 5)
+    day = start + datetime.timedelta(weeks=full_weeks)
+    while day.weekday() >= 5:
+        day += datetime.timedelta(days=1)
+    for _ in range(rest):
+        day += datetime.timedelta(days=1)
+        while day.weekday() >= 5:
+            day += datetime.timedelta(days=1)
+    return day
 
 
 def calculate_merge_date(
     risk: int, urgency: int, config: Config
 ) -> datetime.date:
-    now_relative = now_relative_day(config)
+    # Look at the clock once, so all helpers agree on the current time.
+    now = now_tz()
+    now_relative = now_relative_day(config, now)
+    # Days still ahead in the current cycle first, then those of the next one.
     for day, day_config in sorted(
         config.pr_merge_days.items(),
-        key=lambda item: ("0" if now_relative <= item[0] else "1")
-        + str(item[0]),
+        key=lambda item: (item[0] < now_relative, item[0]),
     ):
         if day_config.max_risk >= risk and day_config.min_urgency <= urgency:
-            return convert_relative_day_to_date(day, config)
+            return convert_relative_day_to_date(day, config, now)
 
 
-def get_label_values_for_pr(labels: list[Label]) -> (int | None, int | None):
+def get_label_values_for_pr(labels: list[str]) -> (int | None, int | None):
     risk = None
     urgency = None
     for label in labels:
-        if label.name.startswith("risk:"):
-            risk = int(label.name.split("risk:")[1])
-        if label.name.startswith("urgency:"):
-            urgency = int(label.name.split("urgency:")[1])
+        if label.startswith("risk:"):
+            risk = int(label.split("risk:")[1])
+        if label.startswith("urgency:"):
+            urgency = int(label.split("urgency:")[1])
     return risk, urgency
 
 
-def check_pr_mergeable(
-    repo: Repository, pr: PullRequest, token: str, config: Config
-) -> bool:
+# Check conclusions (CheckRun) and states (StatusContext) that `gh pr checks`
+# reports in its "fail" bucket.
+FAILED_CHECK_STATES = {
+    "ACTION_REQUIRED",
+    "CANCELLED",
+    "ERROR",
+    "FAILURE",
+    "STARTUP_FAILURE",
+    "TIMED_OUT",
+}
+
+# The check which runs this tool is still in progress and is ignored.
+OWN_CHECK_NAME = "check-auto-mergeability-of-pr"
+
+PR_FIELDS = """
+fragment PRFields on PullRequest {
+  number
+  mergeable
+  isDraft
+  baseRefName
+  reviewDecision
+  labels(first: 100) {
+    nodes {
+      name
+    }
+  }
+  commits(last: 1) {
+    nodes {
+      commit {
+        statusCheckRollup {
+          contexts(first: 100) {
+            nodes {
+              ... on CheckRun {
+                name
+                conclusion
+              }
+              ... on StatusContext {
+                context
+                state
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+OPEN_PRS_QUERY = gql(
+    """
+    query ($owner: String!, $name: String!, $cursor: String) {
+      repository(owner: $owner, name: $name) {
+        pullRequests(states: OPEN, first: 50, after: $cursor) {
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+          nodes {
+            ...PRFields
+          }
+        }
+      }
+    }
+    """
+    + PR_FIELDS
+)
+
+PR_QUERY = gql(
+    """
+    query ($owner: String!, $name: String!, $number: Int!) {
+      repository(owner: $owner, name: $name) {
+        pullRequest(number: $number) {
+          ...PRFields
+        }
+      }
+    }
+    """
+    + PR_FIELDS
+)
+
+
+@dataclass
+class PRInfo:
+    number: int
+    mergeable: bool
+    draft: bool
+    base_ref: str
+    labels: list[str]
+    review_decision: str | None
+    failed_checks: list[str]
+
+    @classmethod
+    def from_graphql(cls, node: dict) -> Self:
+        failed_checks = []
+        for commit in node["commits"]["nodes"]:
+            rollup = commit["commit"]["statusCheckRollup"]
+            if rollup is None:
+                continue
+            for check in rollup["contexts"]["nodes"]:
+                name = check.get("name") or check.get("context")
+                state = check.get("conclusion") or check.get("state")
+                if name != OWN_CHECK_NAME and state in FAILED_CHECK_STATES:
+                    failed_checks.append(name)
+        return cls(
+            number=node["number"],
+            mergeable=node["mergeable"] == "MERGEABLE",
+            draft=node["isDraft"],
+            base_ref=node["baseRefName"],
+            labels=[label["name"] for label in node["labels"]["nodes"]],
+            review_decision=node["reviewDecision"],
+            failed_checks=failed_checks,
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def graphql_client(token: str) -> Client:
+    """One client per token for the whole run. The queries are written by
+    hand, so the schema is not fetched."""
+    transport = RequestsHTTPTransport(
+        url="https://api.github.com/graphql",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    return Client(transport=transport, fetch_schema_from_transport=False)
+
+
+def fetch_open_prs(repo: Repository, token: str) -> list[PRInfo]:
+    """Fetch everything needed to decide about merging all open PRs, with one
+    GraphQL request per 50 PRs."""
+    client = graphql_client(token)
+    variables = {"owner": repo.owner.login, "name": repo.name, "cursor": None}
+    prs = []
+    while True:
+        result = client.execute(OPEN_PRS_QUERY, variable_values=variables)
+        pull_requests = result["repository"]["pullRequests"]
+        prs += map(PRInfo.from_graphql, pull_requests["nodes"])
+        if not pull_requests["pageInfo"]["hasNextPage"]:
+            return prs
+        variables["cursor"] = pull_requests["pageInfo"]["endCursor"]
+
+
+def fetch_pr(repo: Repository, number: int, token: str) -> PRInfo:
+    result = graphql_client(token).execute(
+        PR_QUERY,
+        variable_values={
+            "owner": repo.owner.login,
+            "name": repo.name,
+            "number": number,
+        },
+    )
+    return PRInfo.from_graphql(result["repository"]["pullRequest"])
+
+
+def check_pr_mergeable(pr: PRInfo, config: Config) -> bool:
     if not pr.mergeable:
         logging.info(f"PR {pr.number} has conflicts. Not mergeable.")
         return False
@@ -119,72 +282,22 @@ def check_pr_mergeable(
         return False
 
     # Check that this PR is against a dev branch
-    if (
-        re.match(
-            rf"^fc-({'|'.join(config.general.platform_versions)})-dev$",
-            pr.base.ref,
-        )
-        is None
-    ):
+    allowed_refs = {f"fc-{v}-dev" for v in config.general.platform_versions}
+    if pr.base_ref not in allowed_refs:
         logging.info(
             f"PR {pr.number} is not against a allowed dev branch. Not auto mergeable."
         )
         return False
 
-    # Check if the PR has enough approvals
-    transport = RequestsHTTPTransport(
-        url="https://api.github.com/graphql",
-        headers={"Authorization": f"Bearer {token}"},
-    )
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-
-    query = gql(
-        f"""
-      query {{
-        repository(name: "{repo.name}", owner: "{repo.owner.login}") {{
-          pullRequest(number: {pr.number}) {{
-            reviewDecision
-          }}
-        }}
-      }}
-      """
-    )
-
-    result = client.execute(query)
     # reviewDecision considers the policy configured for the repository
-    result_pr = result["repository"]["pullRequest"]
-    review_decision = result_pr["reviewDecision"]
-    # if review_decision != "APPROVED":
+    # if pr.review_decision != "APPROVED":
     #    logging.info(f"PR {pr.number} has not enough approvals. Not mergeable.")
     #    return False
 
-    # check if all status checks were successful
-    gh_process_env = os.environ.copy()
-    gh_process_env["GH_TOKEN"] = token
-    workflow_runs_cmd = subprocess.check_output(
-        [
-            "gh",
-            "pr",
-            "checks",
-            "53",
-            "--json",
-            "bucket,name",
-            "-R",
-            config.general.fc_nixos_repo_name,
-        ],
-        env=gh_process_env,
-    )
-
-    logging.debug(workflow_runs_cmd)
-    workflow_runs = json.loads(workflow_runs_cmd)
-
     # Check that all workflow runs except for the current are successful
-    for workflow_run in workflow_runs:
-        if workflow_run["name"] == "check-auto-mergeability-of-pr":
-            continue
-        if workflow_run["bucket"] == "fail":
-            logging.info(
-                f"Workflow run {workflow_run['name']} is unsuccessful. Not mergeable."
-            )
-            return False
+    if pr.failed_checks:
+        logging.info(
+            f"Workflow run {pr.failed_checks[0]} is unsuccessful. Not mergeable."
+        )
+        return False
     return True
@@ -3,13 +3,14 @@ import datetime
 import logging
 import os
 import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from typing import Optional
 
 from rich import print
 from rich.logging import RichHandler
 
-from . import branch, doc
 from .state import STAGE, State, load_state, new_state, store_state
 from .utils import prompt
 
@@ -20,9 +21,18 @@ AVAILABLE_CMDS = {
     STAGE.DONE: ["init", "status"],
 }
 
+release_date_re = re.compile(r"\d{4}-\d{2}-\d{2}$")
+
 
 def release_id_type(arg_value):
-    if not re.compile("^[0-9]{4}_[0-9]{3}$").match(arg_value):
+    year, sep, num = arg_value.partition("_")
+    if not (
+        sep
+        and len(year) == 4
+        and len(num) == 3
+        and (year + num).isascii()
+        and (year + num).isdigit()
+    ):
         raise argparse.ArgumentTypeError(
             "Release ID must be formatted as YYYY_NNN"
         )
@@ -30,7 +40,7 @@ def release_id_type(arg_value):
 
 
 def release_date_type(arg_value):
-    if not re.match(r"\d{4}-\d{2}-\d{2}$", arg_value):
+    if not release_date_re.match(arg_value):
         raise argparse.ArgumentTypeError(
             "Release date must be formatted as YYYY-MM-DD"
         )
@@ -52,21 +62,35 @@ def init(
     release_id: Optional[str],
     release_date: Optional[datetime.date],
 ):
+    from . import doc
+
     state.clear()
     state.update(new_state())
-    if not release_date:
-        today = datetime.date.today()
-        # next monday
-        default = today + datetime.timedelta(days=8 - today.isoweekday())
-        release_date = prompt(
-            "Release date?", default=default, conv=release_date_type
-        )
-    if not release_id:
-        release_id = prompt(
-            "Release id?",
-            default=doc.next_release_id(release_date),
-            conv=release_id_type,
-        )
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        if not release_id:
+            # fetch the docs repo while the user picks the release date
+            docs_fetched = pool.submit(doc.prefetch_repo)
+        if not release_date:
+            today = datetime.date.today()
+            # next monday
+            default = today + datetime.timedelta(days=8 - today.isoweekday())
+            release_date = prompt(
+                "Release date?", default=default, conv=release_date_type
+            )
+        if not release_id:
+            fetched, output = docs_fetched.result()
+            sys.stdout.flush()
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+            if fetched:
+                doc.reset_repo()
+            else:
+                doc.update_repo()
+            release_id = prompt(
+                "Release id?",
+                default=doc.next_release_id(release_date),
+                conv=release_id_type,
+            )
     state["release_id"] = release_id
     state["release_date"] = release_date.isoformat()
     state["stage"] = STAGE.BRANCH
@@ -145,9 +169,23 @@ def main():
         handlers=[RichHandler()],
     )
     os.environ["PAGER"] = ""
+    if sys.argv[1:] == ["status"]:
+        # most common invocation, no need to build the whole parser
+        status(load_state())
+        return
+
+    # Only import the command modules (and rich.prompt etc.) when a command
+    # that needs them is run.
+    from . import branch, doc
+
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
+    parser.add_argument(
+        "--force-fetch",
+        action="store_true",
+        help="Always fetch repositories, even if they were fetched recently.",
+    )
     subparser = parser.add_subparsers(dest="command")
 
     init_parser = subparser.add_parser("init")
@@ -200,6 +238,9 @@ def main():
         parser.print_usage()
         return
 
+    if args.force_fetch:
+        os.environ["FC_FORCE_FETCH"] = "1"
+
     state = load_state()
 
     if args.command not in AVAILABLE_CMDS[state["stage"]]:
@@ -209,9 +250,11 @@ def main():
         return
 
     func = args.func
-    kwargs = dict(args._get_kwargs())
-    del kwargs["func"]
-    del kwargs["command"]
+    kwargs = {
+        k: v
+        for k, v in vars(args).items()
+        if k not in ("func", "command", "force_fetch")
+    }
     func(state, **kwargs)
     if func != status:
         print()
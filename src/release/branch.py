@@ -1,22 +1,31 @@
+import json
 import logging
+import shutil
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 
-import requests
 from rich import print
-from rich.prompt import Confirm
 
 from .markdown import MarkdownTree
 from .state import STAGE, State
 from .utils import (
     FC_NIXOS,
+    FC_NIXOS_URL,
+    GH,
+    GitCatFile,
     checkout,
     ensure_repo,
     git,
-    git_stdout,
-    load_json,
+    git_cached,
+    iter_files,
+    ls_remote,
     machine_prefix,
     prompt,
     rev_parse,
+    rev_parse_many,
+    update_refs,
 )
 
 STEPS = [
@@ -34,21 +43,48 @@ STEPS = [
 CHANGELOG = FC_NIXOS / "changelog.d" / "CHANGELOG.md"
 
 
-def generate_nixpkgs_changelog(old_rev: str, new_rev: str) -> MarkdownTree:
+def generate_nixpkgs_changelog(
+    old_rev: str, new_rev: str
+) -> tuple[MarkdownTree, list[str]]:
+    """Returns the changelog fragment and the warnings that were logged."""
     res = MarkdownTree()
+    warnings = []
     res[
         "Detailed Changes"
     ] += f"- [platform code](https://github.com/flyingcircusio/fc-nixos/compare/{old_rev}...{new_rev})"
 
     pversions_path = "release/package-versions.json"
-    try:
-        old_pversions = load_json(FC_NIXOS, old_rev, pversions_path)
-        new_pversions = load_json(FC_NIXOS, new_rev, pversions_path)
+    versions_path = "release/versions.json"
+    with GitCatFile(FC_NIXOS) as cat_file:
+        old_pversions, new_pversions, old_versions, new_versions = (
+            cat_file.get_many(
+                (old_rev, pversions_path),
+                (new_rev, pversions_path),
+                (old_rev, versions_path),
+                (new_rev, versions_path),
+            )
+        )
 
+    if old_pversions is None or new_pversions is None:
+        warnings.append(
+            f"Could not find '{pversions_path}'. Continuing without package versions diff..."
+        )
+        logging.warning(warnings[-1])
+    else:
+        old_pversions = json.loads(old_pversions)
+        new_pversions = json.loads(new_pversions)
+
+        old_versions_by_pkg = {
+            k: v.get("version") for k, v in old_pversions.items()
+        }
+        new_versions_by_pkg = {
+            k: v.get("version") for k, v in new_pversions.items()
+        }
         lines = []
-        for pkg_name in old_pversions:
-            old = old_pversions.get(pkg_name, {}).get("version")
-            new = new_pversions.get(pkg_name, {}).get("version")
+        # packages only present in the new revision come last
+        for pkg_name in old_versions_by_pkg | new_versions_by_pkg:
+            old = old_versions_by_pkg.get(pkg_name)
+            new = new_versions_by_pkg.get(pkg_name)
 
             if not old and new:
                 lines.append(f"{pkg_name}: (old version missing)")
@@ -62,27 +98,21 @@ def generate_nixpkgs_changelog(old_rev: str, new_rev: str) -> MarkdownTree:
                 "- Pull upstream NixOS changes, security fixes and package updates:"
                 + "".join("\n    - " + m for m in lines)
             )
-    except subprocess.CalledProcessError:
-        logging.warning(
-            f"Could not find '{pversions_path}'. Continuing without package versions diff..."
-        )
 
-    versions_path = "release/versions.json"
-    try:
-        old_versions = load_json(FC_NIXOS, old_rev, versions_path)
-        new_versions = load_json(FC_NIXOS, new_rev, versions_path)
-        old_nixpkgs_rev = old_versions["nixpkgs"]["rev"]
-        new_nixpkgs_rev = new_versions["nixpkgs"]["rev"]
+    if old_versions is None or new_versions is None:
+        warnings.append(
+            f"Could not find '{versions_path}' file. Continuing without nixpkgs changelog..."
+        )
+        logging.warning(warnings[-1])
+    else:
+        old_nixpkgs_rev = json.loads(old_versions)["nixpkgs"]["rev"]
+        new_nixpkgs_rev = json.loads(new_versions)["nixpkgs"]["rev"]
         if old_nixpkgs_rev != new_nixpkgs_rev:
             res[
                 "Detailed Changes"
             ] += f"- [nixpkgs/upstream changes](https://github.com/flyingcircusio/nixpkgs/compare/{old_nixpkgs_rev}...{new_nixpkgs_rev})"
-    except subprocess.CalledProcessError:
-        logging.warning(
-            f"Could not find '{versions_path}' file. Continuing without nixpkgs changelog..."
-        )
 
-    return res
+    return res, warnings
 
 
 class Release:
@@ -96,78 +126,149 @@ class Release:
         self.branch_stag = f"fc-{self.nixos_version}-staging"
         self.branch_prod = f"fc-{self.nixos_version}-production"
 
+    @cached_property
+    def branch_revs(self) -> dict[str, str]:
+        """Commit ids of the dev, staging and production branches before
+        anything is merged."""
+        branches = (self.branch_dev, self.branch_stag, self.branch_prod)
+        return dict(zip(branches, rev_parse_many(FC_NIXOS, *branches)))
+
     def prepare(self):
-        ensure_repo(FC_NIXOS, "git@github.com:flyingcircusio/fc-nixos.git")
+        ensure_repo(FC_NIXOS, FC_NIXOS_URL)
 
-        checkout(FC_NIXOS, self.branch_dev, reset=True, clean=True)
-        checkout(FC_NIXOS, self.branch_stag, reset=True, clean=True)
+        # Only production needs a working tree here. Dev and staging are
+        # reset without checking them out, as every later step checks out
+        # the branch it works on anyway.
         checkout(FC_NIXOS, self.branch_prod, reset=True, clean=True)
+        update_refs(
+            FC_NIXOS,
+            *(
+                f"update refs/heads/{branch} origin/{branch}"
+                for branch in (self.branch_dev, self.branch_stag)
+            ),
+        )
 
         if "orig_staging_commit" not in self.branch_state:
-            self.branch_state["orig_staging_commit"] = rev_parse(
-                FC_NIXOS, self.branch_stag
-            )
+            self.branch_state["orig_staging_commit"] = self.branch_revs[
+                self.branch_stag
+            ]
+
+    def skip_no_remote_change(self):
+        """Cheap variant of skip_no_change that only asks the remote, so
+        nothing needs to be fetched for a version without changes."""
+        revs = ls_remote(FC_NIXOS_URL, self.branch_stag, self.branch_prod)
+        stag_rev = revs.get(self.branch_stag)
+        if stag_rev is not None and stag_rev == revs.get(self.branch_prod):
+            logging.error(f"No changes for {self.nixos_version} detected")
+            raise SystemExit(1)
 
     def skip_no_change(self):
-        try:
-            git(
+        stag_rev = self.branch_revs[self.branch_stag]
+        prod_rev = self.branch_revs[self.branch_prod]
+        if stag_rev != prod_rev:
+            proc = git(
                 FC_NIXOS,
                 "merge-base",
                 "--is-ancestor",
-                self.branch_stag,
-                self.branch_prod,
+                stag_rev,
+                prod_rev,
+                check=False,
+                stdout=subprocess.DEVNULL,
             )
-            logging.error(f"No changes for {self.nixos_version} detected")
-            raise SystemExit(1)
-        except subprocess.CalledProcessError as e:
-            if e.returncode != 1:
-                raise
+            if proc.returncode == 1:
+                # staging has commits that are not in production yet
+                return
+            proc.check_returncode()
+        logging.error(f"No changes for {self.nixos_version} detected")
+        raise SystemExit(1)
 
     def diff_release(self):
-        def cherry(upstream: str, head: str):
-            res = git_stdout(FC_NIXOS, "cherry", upstream, head, "-v")
-            print(
-                f"Commits in {head}, not in {upstream} ({len(res.splitlines())}):"
-            )
+        def print_cherry(upstream: str, head: str, res: bytes):
+            num_commits = res.count(b"\n")
+            print(f"Commits in {head}, not in {upstream} ({num_commits}):")
             print()
             print(f"git cherry '{upstream}' '{head}' -v")
-            print(res)
+            # raw bytes: no decoding, and commit subjects are not parsed
+            # as rich markup
+            sys.stdout.flush()
+            sys.stdout.buffer.write(res + b"\n")
+            sys.stdout.flush()
             print()
 
-        dev_rev = rev_parse(FC_NIXOS, self.branch_dev)
-        stag_rev = rev_parse(FC_NIXOS, self.branch_stag)
-        prod_rev = rev_parse(FC_NIXOS, self.branch_prod)
-
-        print(
-            f"Comparing {self.branch_dev} to {self.branch_prod} {prod_rev}..{dev_rev}"
-        )
-        print(f"{self.branch_stag} is at {stag_rev}")
+        revs = self.branch_revs
+        dev_rev = revs[self.branch_dev]
+        stag_rev = revs[self.branch_stag]
+        prod_rev = revs[self.branch_prod]
+
+        # The git commands are independent of each other and of `gh`, so
+        # run them in the background while the PR list is fetched and the
+        # user reads the cherry output.
+        with ThreadPoolExecutor() as pool:
+            cherries = {
+                upstream: pool.submit(
+                    git_cached,
+                    FC_NIXOS,
+                    "cherry",
+                    revs[upstream],
+                    dev_rev,
+                    "-v",
+                )
+                for upstream in (self.branch_stag, self.branch_prod)
+            }
+            pending_diff = pool.submit(
+                git_cached,
+                FC_NIXOS,
+                "diff",
+                "--color=always",
+                prod_rev,
+                dev_rev,
+            )
 
-        print("")
-        print("Merged PRs:")
-        print()
-        print(f"gh pr list --state=merged -B '{self.branch_dev}'")
-        try:
-            subprocess.run(
-                ["gh", "pr", "list", "--state=merged", "-B", self.branch_dev],
-                cwd=FC_NIXOS,
+            print(
+                f"Comparing {self.branch_dev} to {self.branch_prod} {prod_rev}..{dev_rev}"
             )
-        except FileNotFoundError:
-            print("'gh' is not available. Please check merged PRs manually")
-        print()
+            print(f"{self.branch_stag} is at {stag_rev}")
 
-        cherry(self.branch_stag, self.branch_dev)
-        cherry(self.branch_prod, self.branch_dev)
+            print("")
+            print("Merged PRs:")
+            print()
+            print(f"gh pr list --state=merged -B '{self.branch_dev}'")
+            try:
+                subprocess.run(
+                    [GH, "pr", "list", "--state=merged", "-B", self.branch_dev],
+                    cwd=FC_NIXOS,
+                )
+            except FileNotFoundError:
+                print("'gh' is not available. Please check merged PRs manually")
+            print()
 
-        print(f"git diff '{self.branch_prod}' '{self.branch_dev}'")
-        print("Press Enter to show full diff")
+            for upstream, res in cherries.items():
+                print_cherry(upstream, self.branch_dev, res.result())
 
-        input()
+            print(f"git diff '{self.branch_prod}' '{self.branch_dev}'")
+            print("Press Enter to show full diff")
 
-        git(FC_NIXOS, "diff", self.branch_prod, self.branch_dev)
+            input()
 
-        print("Press enter to continue")
-        input()
+            diff = pending_diff.result()
+
+        try:
+            pager = subprocess.Popen(["less", "-R"], stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(diff)
+            sys.stdout.flush()
+            print("Press enter to continue")
+            input()
+        else:
+            # The pager already waits for the user to quit it.
+            try:
+                pager.stdin.write(diff)
+                pager.stdin.close()
+            except BrokenPipeError:
+                # quit the pager before reading the whole diff
+                pass
+            pager.wait()
 
     def check_hydra(self):
         orig_stag_rev = self.branch_state.get(
@@ -201,8 +302,8 @@ class Release:
             )
             return
 
-        new_fragment = MarkdownTree.collect(
-            filter(CHANGELOG.__ne__, CHANGELOG.parent.rglob("*.md")), FC_NIXOS
+        new_fragment, fragment_files = MarkdownTree.collect(
+            filter(CHANGELOG.__ne__, iter_files(CHANGELOG.parent, ".md"))
         )
 
         old_changelog = MarkdownTree.from_str(
@@ -213,13 +314,28 @@ class Release:
 
         new_fragment.strip()
         new_fragment.add_header(f"Release {self.release_id}")
-        new_changelog = new_fragment.to_str()
-        if CHANGELOG.exists():
-            new_changelog += "\n" + CHANGELOG.read_text()
-        CHANGELOG.write_text(new_changelog)
+        # Prepend the new entries without reading the whole old changelog
+        # into memory.
+        tmp_changelog = CHANGELOG.with_suffix(".tmp")
+        with tmp_changelog.open("w") as f:
+            f.write(new_fragment.to_str())
+            if CHANGELOG.exists():
+                f.write("\n")
+                with CHANGELOG.open() as old_changelog_file:
+                    shutil.copyfileobj(old_changelog_file, f)
+        tmp_changelog.replace(CHANGELOG)
 
         try:
-            git(FC_NIXOS, "add", str(CHANGELOG.relative_to(FC_NIXOS)))
+            # stages the new CHANGELOG and all removed fragments at once
+            git(
+                FC_NIXOS,
+                "add",
+                "--",
+                *(
+                    str(f.relative_to(FC_NIXOS))
+                    for f in [CHANGELOG, *fragment_files]
+                ),
+            )
             git(FC_NIXOS, "commit", "-m", "Collect changelog fragments")
         except subprocess.CalledProcessError:
             logging.error(
@@ -244,16 +360,25 @@ class Release:
         git(FC_NIXOS, "merge", "-m", msg, self.branch_prod)
 
     def add_detailed_changelog(self):
-        old_rev = rev_parse(FC_NIXOS, "origin/" + self.branch_prod)
-        new_rev = rev_parse(FC_NIXOS, self.branch_prod)
+        old_rev, new_rev = rev_parse_many(
+            FC_NIXOS, "origin/" + self.branch_prod, self.branch_prod
+        )
 
         new_fragment = MarkdownTree.from_str(
             self.branch_state.get("changelog", "")
         )
-        new_fragment |= generate_nixpkgs_changelog(old_rev, new_rev)
+        nixpkgs_changelog, warnings = generate_nixpkgs_changelog(
+            old_rev, new_rev
+        )
+        new_fragment |= nixpkgs_changelog
 
-        print("Press enter to edit the generated changelog fragment")
-        input()
+        if warnings:
+            # The editor would hide the warnings, give the user time to read
+            # them first.
+            print("Press enter to edit the generated changelog fragment")
+            input()
+        else:
+            print("Opening the generated changelog fragment in the editor")
         new_fragment.open_in_editor()
         self.branch_state["changelog"] = new_fragment.to_str()
 
@@ -281,6 +406,8 @@ def add_branch(state: State, nixos_version: str, steps: list[str]):
         logging.warning(
             f"Branch '{nixos_version}' already added or no longer in 'branch' stage"
         )
+        from rich.prompt import Confirm
+
         if not Confirm.ask(
             "Do you want to (re-)add this branch? "
             "(This will reset the stage back to 'branch' and may result in duplicate changelog entries)"
@@ -289,6 +416,8 @@ def add_branch(state: State, nixos_version: str, steps: list[str]):
         state["stage"] = STAGE.BRANCH
     release = Release(state, nixos_version)
     logging.info(f"Adding {nixos_version} to {state['release_id']}")
+    if "skip_no_change" in steps:
+        release.skip_no_remote_change()
     for step_name in steps:
         logging.info(f"Release step: {step_name}")
         getattr(release, step_name)()
@@ -303,6 +432,9 @@ def test_branch(state: State, nixos_version: str):
         logging.error(f"'{nixos_version}' already tested")
         return
 
+    # Only needed here, so other commands do not pay for importing it.
+    import requests
+
     changelog = MarkdownTree.from_str(branch_state.get("changelog", ""))
     prod_commit = branch_state.get("new_production_commit", "<unknown rev>")
     print(f"Production: hydra commit id correct? ({prod_commit}), build green?")
@@ -318,30 +450,35 @@ def test_branch(state: State, nixos_version: str):
 
     metadata_url = f"https://my.flyingcircus.io/releases/metadata/fc-{nixos_version}-production/{state['release_id']}"
     changelog["Detailed Changes"] += f"- [metadata]({metadata_url})"
-    try:
-        r = requests.get(metadata_url, timeout=5)
-        r.raise_for_status()
-        channel_url = r.json()["channel_url"]
-        changelog["Detailed Changes"] += f"- [channel url]({channel_url})"
-        logging.info("Added channel url fragment")
-    except (requests.RequestException, KeyError):
-        logging.warning(
-            "Failed to retrieve channel url. Please add it manually in the next step"
-        )
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # The release exists now, so look up its metadata while the user
+        # tests the new system.
+        metadata = pool.submit(requests.get, metadata_url, timeout=5)
 
-    if nixos_version == "21.05":
-        print(
-            "Production: switch a test VM to the 21.05-production-next channel. Is it working correctly?"
-        )
-    else:
-        prefix = machine_prefix(nixos_version)
+        if nixos_version == "21.05":
+            print(
+                "Production: switch a test VM to the 21.05-production-next channel. Is it working correctly?"
+            )
+        else:
+            prefix = machine_prefix(nixos_version)
+            print(
+                f"Production: On {prefix}prod00, switch to new system. Is it working correctly?"
+            )
         print(
-            f"Production: On {prefix}prod00, switch to new system. Is it working correctly?"
+            "Check switch output for unexpected service restarts, compare with changelog, impact properly documented? [Enter to edit]"
         )
-    print(
-        "Check switch output for unexpected service restarts, compare with changelog, impact properly documented? [Enter to edit]"
-    )
-    input()
+        input()
+
+        try:
+            r = metadata.result()
+            r.raise_for_status()
+            channel_url = r.json()["channel_url"]
+            changelog["Detailed Changes"] += f"- [channel url]({channel_url})"
+            logging.info("Added channel url fragment")
+        except (requests.RequestException, KeyError):
+            logging.warning(
+                "Failed to retrieve channel url. Please add it manually in the next step"
+            )
 
     changelog.open_in_editor()
     branch_state["changelog"] = changelog.to_str()
@@ -350,18 +487,20 @@ def test_branch(state: State, nixos_version: str):
 
 
 def tag_branch(state: State):
-    ensure_repo(FC_NIXOS, "git@github.com:flyingcircusio/fc-nixos.git")
+    ensure_repo(FC_NIXOS, FC_NIXOS_URL)
     print(
         "activate 'keep' for the Hydra job flyingcircus:fc-*-production:release [Enter]"
     )
     input()
-    for nixos_version in state["branches"].keys():
-        git(
-            FC_NIXOS,
-            "tag",
-            f"fc/r{state['release_id']}/{nixos_version}",
-            f"fc-{nixos_version}-production",
-        )
+    # Lightweight tags, like `git tag <name> <commit>`, created at once
+    update_refs(
+        FC_NIXOS,
+        *(
+            f"create refs/tags/fc/r{state['release_id']}/{nixos_version} "
+            f"fc-{nixos_version}-production"
+            for nixos_version in state["branches"].keys()
+        ),
+    )
 
     git(FC_NIXOS, "push", "--tags")
     state["stage"] = STAGE.DONE
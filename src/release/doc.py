@@ -1,13 +1,20 @@
 import datetime
 import logging
+import os
+import shutil
 import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Optional
 
 from rich import print
 
 from .markdown import MarkdownTree
 from .state import STAGE, State
-from .utils import FC_DOCS, checkout, ensure_repo, git
+from .utils import FC_DOCS, GH, checkout, ensure_repo, git
 
+DOCS_URL = "git@github.com:flyingcircusio/doc.git"
 FRAGMENTS_DIR = FC_DOCS / "changelog.d"
 
 RELEASE_INDEX_TEMPLATE = """\
@@ -39,10 +46,28 @@ infrastructure in reverse chronological order.
 """
 
 
-def update_index(year: str) -> None:
+def _scan(path: Path) -> list[os.DirEntry]:
+    """Directory entries of `path`, empty if it does not exist."""
+    try:
+        with os.scandir(path) as it:
+            return list(it)
+    except FileNotFoundError:
+        return []
+
+
+def _release_files(year_dir: Path) -> list[str]:
+    return [
+        e.name.removesuffix(".md")
+        for e in _scan(year_dir)
+        if e.name.startswith("r") and e.name.endswith(".md") and e.is_file()
+    ]
+
+
+def update_index(year: str) -> list[Path]:
+    """Rewrite the changelog index files and return them for staging."""
     year_index_file = FC_DOCS / "src/changes/index.md"
     years = [
-        e.name + "/index" for e in FC_DOCS.glob("src/changes/*") if e.is_dir()
+        e.name + "/index" for e in _scan(FC_DOCS / "src/changes") if e.is_dir()
     ]
     year_index_content = YEAR_INDEX_TEMPLATE.format(
         years="\n".join(sorted(years, reverse=True))
@@ -50,40 +75,68 @@ def update_index(year: str) -> None:
     year_index_file.write_text(year_index_content)
 
     release_index_file = FC_DOCS / f"src/changes/{year}/index.md"
-    releases = [
-        e.name.removesuffix(".md")
-        for e in FC_DOCS.glob(f"src/changes/{year}/r*.md")
-        if e.is_file()
-    ]
+    releases = _release_files(release_index_file.parent)
     release_index_content = RELEASE_INDEX_TEMPLATE.format(
         year=year, releases="\n".join(sorted(releases))
     )
     release_index_file.write_text(release_index_content)
 
-    git(
-        FC_DOCS,
-        "add",
-        str(release_index_file.relative_to(FC_DOCS)),
-        str(year_index_file.relative_to(FC_DOCS)),
-    )
+    return [release_index_file, year_index_file]
 
 
-def next_release_id(date: datetime.date) -> str:
-    ensure_repo(FC_DOCS, "git@github.com:flyingcircusio/doc.git")
+def update_repo() -> None:
+    ensure_repo(FC_DOCS, DOCS_URL, "--filter=blob:none")
+    reset_repo()
+
+
+def reset_repo() -> None:
     checkout(FC_DOCS, "master", reset=True, clean=True)
 
+
+def prefetch_repo() -> tuple[bool, bytes]:
+    """Fetch the docs repository without touching the terminal, so it can run
+    in the background while the user is prompted.
+
+    Returns whether the fetch worked and the output of git. If it did not,
+    use `update_repo` to retry in the foreground.
+    """
+    env = dict(os.environ)
+    # fail instead of asking for credentials
+    env["GIT_TERMINAL_PROMPT"] = "0"
+    with tempfile.TemporaryFile() as out:
+        try:
+            ensure_repo(
+                FC_DOCS,
+                DOCS_URL,
+                "--filter=blob:none",
+                env=env,
+                # Without a controlling terminal, ssh fails instead of asking
+                # for a passphrase or host key. This leaves the configured
+                # ssh command alone.
+                start_new_session=True,
+                stdout=out,
+                stderr=subprocess.STDOUT,
+            )
+            ok = True
+        except subprocess.CalledProcessError:
+            ok = False
+        out.seek(0)
+        return ok, out.read()
+
+
+def next_release_id(date: datetime.date) -> str:
+    """Expects an up to date checkout, see `update_repo`."""
     years = sorted(
         int(e.name)
-        for e in FC_DOCS.glob("src/changes/*")
-        if e.is_dir() and e.name.isdigit()
+        for e in _scan(FC_DOCS / "src/changes")
+        if e.name.isdigit() and e.is_dir()
     )
     if not years or years[-1] != date.year:
         return f"{date.year}_001"
 
     releases = [
-        e.name.removesuffix(".md").removeprefix("r")
-        for e in FC_DOCS.glob(f"src/changes/{years[-1]}/r*.md")
-        if e.is_file()
+        r.removeprefix("r")
+        for r in _release_files(FC_DOCS / f"src/changes/{years[-1]}")
     ]
     releases = sorted(int(r) for r in releases if r.isdigit())
     if not releases:
@@ -102,9 +155,9 @@ def collect_changelogs(state: State) -> MarkdownTree:
         frag = MarkdownTree.from_str(v.get("changelog", ""))
         frag["Impact"].add_header(k)
         frag.rename("NixOS XX.XX platform", f"NixOS {k} platform")
-        if frag["Detailed Changes"].entries:
+        if details := frag["Detailed Changes"].entries:
             frag["Detailed Changes"] = f"- NixOS {k}: " + ", ".join(
-                e.removeprefix("- ") for e in frag["Detailed Changes"].entries
+                [e.removeprefix("- ") for e in details]
             )
         changelog |= frag
     changelog["Documentation"] += "<!--\nadd entries if necessary\n-->"
@@ -121,6 +174,25 @@ def collect_changelogs(state: State) -> MarkdownTree:
     return changelog
 
 
+def list_prs() -> Optional[subprocess.Popen]:
+    """Start `gh pr list` for the docs repository in the background.
+
+    Returns None if `gh` is not installed.
+    """
+    env = dict(os.environ)
+    # keep the terminal formatting although the output is captured
+    env["GH_FORCE_TTY"] = str(shutil.get_terminal_size().columns)
+    try:
+        return subprocess.Popen(
+            [GH, "pr", "list", "--state=all", "-B", "master"],
+            cwd=FC_DOCS,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+    except FileNotFoundError:
+        return None
+
+
 def main(state: State):
     for k, v in state["branches"].items():
         if "tested" not in v:
@@ -131,16 +203,18 @@ def main(state: State):
         "This will release the changelog for the following versions: "
         + ", ".join(branches)
     )
-    ensure_repo(FC_DOCS, "git@github.com:flyingcircusio/doc.git")
-    checkout(FC_DOCS, "master", reset=True, clean=True)
+    # `gh` only needs the configured remote, so if the checkout already
+    # exists, list the PRs while the repository is being fetched.
+    pr_list = list_prs() if FC_DOCS.exists() else None
+    update_repo()
+    pr_list = pr_list or list_prs()
 
     print("Review open/merged PRs:")
-    try:
-        subprocess.run(
-            ["gh", "pr", "list", "--state=all", "-B", "master"],
-            cwd=FC_DOCS,
-        )
-    except FileNotFoundError:
+    if pr_list:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(pr_list.communicate()[0])
+        sys.stdout.flush()
+    else:
         logging.error("'gh' is not available. Please check PRs manually")
 
     year, release_num = state["release_id"].split("_", maxsplit=1)
@@ -150,10 +224,14 @@ def main(state: State):
     new_file.parent.mkdir(exist_ok=True)
     new_file.write_text(changelog.to_str())
 
-    update_index(year)
+    index_files = update_index(year)
 
     logging.info("Committing changes")
-    git(FC_DOCS, "add", str(new_file.relative_to(FC_DOCS)))
+    git(
+        FC_DOCS,
+        "add",
+        *(str(f.relative_to(FC_DOCS)) for f in [new_file, *index_files]),
+    )
     git(FC_DOCS, "commit", "-m", f"add changelog {state['release_id']}")
 
     input("Press enter to push")
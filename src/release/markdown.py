@@ -3,15 +3,12 @@ import subprocess
 from collections import defaultdict
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterable, Optional, Self
+from typing import Iterable, Self
 
-from .utils import EDITOR, TEMP_CHANGELOG, git
+from .utils import EDITOR, TEMP_CHANGELOG
 
 comment_re = re.compile(r"^\s*<!--.*?-->$", flags=re.DOTALL | re.MULTILINE)
-section_re = re.compile(
-    r"^(?P<indent>#+) (?P<title>[^\n]+)\n(?P<body>.*?)(?=^#+ |\Z)(?!(?P=indent)#)",
-    flags=re.DOTALL | re.MULTILINE,
-)
+heading_re = re.compile(r"(#+) ")
 entry_re = re.compile(
     r"^(.+?)(?=\n\n+\S|\n- |\Z)", flags=re.DOTALL | re.MULTILINE
 )
@@ -49,9 +46,14 @@ class MarkdownTree:
 
     def __or__(self, other: Self) -> Self:
         entries = self.entries + other.entries
-        keys = list(self.subtrees)
-        keys += [k for k in other.subtrees if k not in keys]
-        subtrees = {k: self.get(k) | other.get(k) for k in keys}
+        subtrees = {}
+        # keeps the order of self, followed by new sections from other
+        for k in self.subtrees | other.subtrees:
+            mine, theirs = self.subtrees.get(k), other.subtrees.get(k)
+            if mine is not None and theirs is not None:
+                subtrees[k] = mine | theirs
+            else:
+                subtrees[k] = (mine or theirs).clone()
         return MarkdownTree(entries, subtrees)
 
     @classmethod
@@ -63,51 +65,81 @@ class MarkdownTree:
 
     @classmethod
     def from_str(cls, text: str) -> Self:
-        text = comment_re.sub("", text)
-        subtrees = defaultdict(cls)
-        section = section_re.search(text)
-        entries = entry_re.split(text[: section.start()] if section else text)
-        entries = [e.strip() for e in entries if e.strip()]
-        end = len(text)
-        while section:
-            subtrees[section["title"].strip()] |= cls.from_str(section["body"])
-            end = section.end()
-            section = section_re.match(text, pos=end)
-        assert end == len(text)
-
-        return cls(entries, subtrees)
+        if "<!--" in text:
+            text = comment_re.sub("", text)
+        root = cls(subtrees=defaultdict(cls))
+        # Sections that are still open, innermost last. A section ends at
+        # the next heading of the same or a higher level.
+        stack = [(0, root)]
+        # start of the text directly below the innermost open heading
+        start = pos = 0
+        lines = text.split("\n")
+        match_heading = heading_re.match
+        for i, line in enumerate(lines):
+            line_start = pos
+            pos += len(line) + 1
+            heading = match_heading(line)
+            if not heading:
+                continue
+            level = len(heading[1])
+            title = line[heading.end() :]
+            if not title or i == len(lines) - 1:
+                # Not a proper heading. It is kept as text as long as it
+                # does not end the current section.
+                assert level > stack[-1][0], f"Invalid heading: {line!r}"
+                continue
+            stack[-1][1].entries += cls._split_entries(text[start:line_start])
+            while stack[-1][0] >= level:
+                stack.pop()
+            section = stack[-1][1].subtrees.setdefault(title.strip(), cls())
+            stack.append((level, section))
+            start = pos
+        stack[-1][1].entries += cls._split_entries(text[start:])
+        return root
+
+    @staticmethod
+    def _split_entries(text: str) -> list[str]:
+        return [e.strip() for e in entry_re.split(text) if e.strip()]
 
     def to_str(self, indent=1) -> str:
-        res = "".join(f"{e}\n\n" for e in self.entries)
-        if res:
-            res += "\n"
+        out: list[str] = []
+        self._write(out, indent)
+        return "".join(out)
+
+    def _write(self, out: list[str], indent: int) -> None:
+        for e in self.entries:
+            out += (e, "\n\n")
+        if self.entries:
+            out.append("\n")
         for title, body in self.subtrees.items():
-            res += "#" * indent + " " + title + "\n\n"
-            res += body.to_str(indent + 1)
-
-        return res
+            out += ("#" * indent, " ", title, "\n\n")
+            body._write(out, indent + 1)
 
     @classmethod
-    def collect(
-        cls, files: Iterable[Path], git_repo: Optional[Path] = None
-    ) -> Self:
+    def collect(cls, files: Iterable[Path]) -> tuple[Self, list[Path]]:
+        """Merge and remove the files. Returns the merged tree and the
+        removed files."""
         res = cls()
+        removed = []
         for f in files:
             if not f.is_file():
                 continue
             res |= cls.from_str(f.read_text())
             f.unlink()
-            if git_repo:
-                git(git_repo, "add", str(f.relative_to(git_repo)))
-        return res
+            removed.append(f)
+        return res, removed
 
     def strip(self) -> None:
-        for k, v in dict(self.subtrees).items():
+        if not self.subtrees:
+            return
+        for k, v in list(self.subtrees.items()):
             v.strip()
             if not v.entries and not v.subtrees:
                 del self.subtrees[k]
 
     def rename(self, old: str, new: str) -> None:
+        if old == new or old not in self.subtrees:
+            return
         # preserve order
         self.subtrees = {
             (k if k != old else new): v for k, v in self.subtrees.items()
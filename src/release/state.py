@@ -37,7 +37,7 @@ def new_state() -> State:
 def load_state() -> State:
     if not STATE_FILE.exists():
         return new_state()
-    state = json.loads(STATE_FILE.read_text())
+    state = json.loads(STATE_FILE.read_bytes())
     state["branches"] = defaultdict(dict, state["branches"])
     return state
 
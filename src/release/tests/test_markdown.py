@@ -0,0 +1,85 @@
+import pytest
+
+from release.markdown import MarkdownTree
+
+
+def test_from_str_nested_headings():
+    tree = MarkdownTree.from_str(
+        "intro\n\n# A\n\n- a1\n- a2\n\n## B\n\nb1\nstill b1\n\n### C\n\nc1\n"
+    )
+    assert tree == MarkdownTree(
+        ["intro"],
+        {
+            "A": MarkdownTree(
+                ["- a1", "- a2"],
+                {
+                    "B": MarkdownTree(
+                        ["b1\nstill b1"], {"C": MarkdownTree(["c1"])}
+                    )
+                },
+            )
+        },
+    )
+
+
+def test_from_str_merges_repeated_headings():
+    tree = MarkdownTree.from_str(
+        "# A\n\n- a1\n\n## B\n\nb1\n\n# C\n\nc1\n\n# A\n\n- a2\n\n## B\n\nb2\n"
+    )
+    assert list(tree.subtrees) == ["A", "C"]
+    assert tree["A"].entries == ["- a1", "- a2"]
+    assert tree["A"]["B"].entries == ["b1", "b2"]
+    assert tree["C"].entries == ["c1"]
+
+
+def test_from_str_heading_closes_sections():
+    tree = MarkdownTree.from_str(
+        "# A\n\n## B\n\n### C\n\nc\n\n## D\n\nd\n\n# E\n\ne\n"
+    )
+    assert list(tree.subtrees) == ["A", "E"]
+    assert list(tree["A"].subtrees) == ["B", "D"]
+    assert tree["A"]["B"]["C"].entries == ["c"]
+    assert tree["A"]["D"].entries == ["d"]
+    assert tree["E"].entries == ["e"]
+
+
+def test_from_str_skipped_level():
+    tree = MarkdownTree.from_str("# A\n\n### deep\n\nx\n\n## B\n\ny\n")
+    assert list(tree["A"].subtrees) == ["deep", "B"]
+    assert tree["A"]["deep"].entries == ["x"]
+    assert tree["A"]["B"].entries == ["y"]
+
+
+def test_from_str_removes_comments():
+    tree = MarkdownTree.from_str("# A\n<!-- add entries\nhere -->\n- a\n")
+    assert tree["A"].entries == ["- a"]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        # without a title
+        "# A\n\n## \n\ntext\n",
+        # on the last line, without a trailing newline
+        "# A\n\ntext\n\n## B",
+    ],
+)
+def test_from_str_improper_heading_is_text(text):
+    tree = MarkdownTree.from_str(text)
+    assert list(tree.subtrees) == ["A"]
+    assert not tree["A"].subtrees
+    assert len(tree["A"].entries) == 2
+
+
+def test_from_str_improper_heading_closing_section():
+    with pytest.raises(AssertionError, match="Invalid heading"):
+        MarkdownTree.from_str("## A\n\ntext\n\n# \n")
+
+
+def test_to_str_round_trip():
+    tree = MarkdownTree.from_sections("Impact", "Documentation")
+    tree["Impact"] += "- impact"
+    tree["Impact"]["NixOS 24.05"] += "- multi\n  line"
+    tree["Documentation"] += "text"
+    tree.add_header("Release 2024_001")
+    assert MarkdownTree.from_str(tree.to_str()) == tree
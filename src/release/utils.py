@@ -1,10 +1,12 @@
 import argparse
-import json
+import functools
+import hashlib
 import os
-import re
+import shutil
 import subprocess
+import time
 from pathlib import Path
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Iterator, Optional
 
 from rich import get_console
 
@@ -12,7 +14,17 @@ EDITOR = os.environ.get("EDITOR", "nano")
 WORK_DIR = Path("work")
 FC_NIXOS = WORK_DIR / "fc-nixos"
 FC_DOCS = WORK_DIR / "doc"
+FC_NIXOS_URL = "git@github.com:flyingcircusio/fc-nixos.git"
 TEMP_CHANGELOG = WORK_DIR / "temp_changelog.md"
+CACHE_DIR = WORK_DIR / ".cache"
+# Remove cached git output after this many seconds.
+CACHE_MAX_AGE = 14 * 24 * 3600
+# Do not fetch a repository again if it was fetched this recently (in seconds).
+FETCH_MAX_AGE = 300
+# Resolve the executables once instead of searching PATH on every call.
+# Fall back to the bare name so a missing tool still raises FileNotFoundError.
+GIT = shutil.which("git") or "git"
+GH = shutil.which("gh") or "gh"
 
 
 def prompt(
@@ -45,12 +57,63 @@ def prompt(
 
 
 def git(path: Path, *cmd: str, check=True, **kw):
-    return subprocess.run(["git"] + list(cmd), cwd=path, check=check, **kw)
+    if "input" not in kw:
+        # Output is inherited, but none of the commands read input, so do
+        # not hand them the terminal.
+        kw.setdefault("stdin", subprocess.DEVNULL)
+    return subprocess.run([GIT, *cmd], cwd=path, check=check, **kw)
 
 
 def git_stdout(path: Path, *cmd: str, **kw):
-    return subprocess.check_output(
-        ["git"] + list(cmd), cwd=path, text=True, **kw
+    return subprocess.check_output([GIT, *cmd], cwd=path, text=True, **kw)
+
+
+def git_cached(path: Path, *cmd: str) -> bytes:
+    """Like `git_stdout`, but keep the output in CACHE_DIR.
+
+    Only use this for commands whose output is fully determined by their
+    arguments, i.e. which only refer to commit ids and not to branches.
+    """
+    key = hashlib.blake2b(
+        "\0".join([str(path), *cmd]).encode(), digest_size=16
+    ).hexdigest()
+    cache_file = CACHE_DIR / key
+    if cache_file.exists():
+        return cache_file.read_bytes()
+    out = subprocess.check_output([GIT, *cmd], cwd=path)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    prune_cache()
+    tmp_file = cache_file.with_suffix(".tmp")
+    tmp_file.write_bytes(out)
+    tmp_file.replace(cache_file)
+    return out
+
+
+def prune_cache():
+    """Remove entries of CACHE_DIR older than CACHE_MAX_AGE."""
+    cutoff = time.time() - CACHE_MAX_AGE
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            # temporary files of concurrent writers are renamed any moment
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime < cutoff:
+                Path(entry.path).unlink(missing_ok=True)
+
+
+def update_refs(path: Path, *instructions: str):
+    """Apply several ref updates like "update refs/heads/foo <rev>" in a
+    single `git update-ref --stdin` transaction."""
+    git(
+        path,
+        "update-ref",
+        "--stdin",
+        input="".join(f"{i}\n" for i in instructions),
+        text=True,
     )
 
 
@@ -58,23 +121,104 @@ def rev_parse(path: Path, rev: str):
     return git_stdout(path, "rev-parse", "--verify", rev).strip()
 
 
-def load_json(path: Path, rev: str, obj_path: str):
-    return json.loads(git_stdout(path, "show", rev + ":" + obj_path))
+def rev_parse_many(path: Path, *revs: str) -> list[str]:
+    return git_stdout(path, "rev-parse", *revs).split()
+
+
+class GitCatFile:
+    """Long-running `git cat-file --batch` process to read many objects
+    without spawning git for each of them."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.proc = None
 
+    def __enter__(self) -> "GitCatFile":
+        self.proc = subprocess.Popen(
+            [GIT, "cat-file", "--batch"],
+            cwd=self.path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        return self
 
+    def __exit__(self, *exc_info):
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+    def get_many(self, *objs: tuple[str, str]) -> list[bytes | None]:
+        """Request all (rev, path) objects at once before reading the first
+        answer. Missing objects are returned as None.
+
+        The requests must fit into the pipe buffer, so keep this to a
+        handful of objects.
+        """
+        for rev, obj_path in objs:
+            self.proc.stdin.write(f"{rev}:{obj_path}\n".encode())
+        self.proc.stdin.flush()
+        return [self._read_object() for _ in objs]
+
+    def _read_object(self) -> bytes | None:
+        header = self.proc.stdout.readline()
+        if not header:
+            raise RuntimeError(
+                f"git cat-file in {self.path} exited unexpectedly"
+            )
+        if header.endswith((b" missing\n", b" ambiguous\n")):
+            return None
+        data = self.proc.stdout.read(int(header.split()[2]))
+        self.proc.stdout.read(1)  # trailing newline
+        return data
+
+
+def ls_remote(url: str, *branches: str) -> dict[str, str]:
+    """Look up the commit ids of remote branches without fetching."""
+    out = subprocess.check_output(
+        [GIT, "ls-remote", "--heads", url, *branches], text=True
+    )
+    res = {}
+    for line in out.splitlines():
+        rev, _, ref = line.partition("\t")
+        res[ref.removeprefix("refs/heads/")] = rev
+    return res
+
+
+@functools.lru_cache(maxsize=None)
 def git_remote(path: Path):
     out = git_stdout(path, "remote", "-v")
-    return re.findall(r"^origin\s(.+?)\s\(.+\)$", out, re.MULTILINE)
+    urls = []
+    # lines look like "origin\t<url> (fetch)"
+    for line in out.splitlines():
+        name, _, rest = line.partition("\t")
+        if name == "origin":
+            urls.append(rest.rpartition(" ")[0])
+    return urls
 
 
-def ensure_repo(path: Path, url: str, *fetch_args: str):
+def ensure_repo(path: Path, url: str, *fetch_args: str, **kw):
+    """Create `path` if needed and fetch `url` into it as origin.
+
+    Keyword arguments are passed on to each git command.
+    """
     if not path.exists():
         path.mkdir(parents=True)
-        git(path, "init")
+        git(path, "init", **kw)
+        git_remote.cache_clear()
+    # Kept inside the repository, so a new clone or origin is always fetched.
+    stamp = path / ".git" / "fc-last-fetch"
     if (remotes := set(git_remote(path))) != {url}:
         if remotes:
-            git(path, "remote", "rm", "origin", check=False)
-        git(path, "remote", "add", "origin", url)
+            git(path, "remote", "rm", "origin", check=False, **kw)
+        git(path, "remote", "add", "origin", url, **kw)
+        git_remote.cache_clear()
+        stamp.unlink(missing_ok=True)
+    if (
+        os.environ.get("FC_FORCE_FETCH") != "1"
+        and stamp.exists()
+        and time.time() - stamp.stat().st_mtime < FETCH_MAX_AGE
+    ):
+        return
     git(
         path,
         "fetch",
@@ -84,15 +228,41 @@ def ensure_repo(path: Path, url: str, *fetch_args: str):
         "--prune-tags",
         "--force",
         *fetch_args,
+        **kw,
     )
+    stamp.touch()
+
+
+def iter_files(root: Path, suffix: str) -> Iterator[Path]:
+    """Files below `root` ending in `suffix`, in the order `rglob` yields
+    them, but without stat-ing every entry again."""
+    with os.scandir(root) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.name.endswith(suffix) and entry.is_file():
+            yield Path(entry.path)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_files(Path(entry.path), suffix)
 
 
 def checkout(path: Path, branch: str, reset: bool = False, clean: bool = False):
+    # write the working tree with one worker per CPU
+    parallel = ("-c", "checkout.workers=0")
     if reset:
-        git(path, "checkout", "-q", "-f", branch)
-        git(path, "reset", "-q", "--hard", f"origin/{branch}")
+        # check out and reset the branch to origin in one go
+        git(
+            path,
+            *parallel,
+            "checkout",
+            "-q",
+            "-f",
+            "-B",
+            branch,
+            f"origin/{branch}",
+        )
     else:
-        git(path, "checkout", "-q", branch)
+        git(path, *parallel, "checkout", "-q", branch)
     if clean:
         git(path, "clean", "-d", "--force")
 
@@ -91,8 +91,7 @@ def main():
         parser.print_usage()
         sys.exit(1)
 
-    kwargs = dict(args._get_kwargs())
-    del kwargs["func"]
+    kwargs = {k: v for k, v in vars(args).items() if k != "func"}
     kwargs["github_access_token"] = github_access_token
     kwargs["matrix_hookshot_url"] = matrix_hookshot_url
     func(**kwargs)
@@ -5,18 +5,22 @@ all old fc-nixos and nixpkgs PRs/branches that haven't been merged.
 """
 
 import datetime
+import functools
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from logging import info, warning
-from pathlib import Path
 
 from git import GitCommandError, Repo
 from github import Auth, Github
+from github.GitRef import GitRef
 from github.PullRequest import PullRequest
+from github.Repository import Repository
 
 from update_nixpkgs import FC_NIXOS_REPO, NIXPKGS_REPO
+from update_nixpkgs.update import outdated_branches
 from utils.matrix import MatrixHookshot
 
 
@@ -26,12 +30,19 @@ class Remote:
     branches: list[str]
 
 
+@functools.lru_cache(maxsize=None)
+def get_repo(gh: Github, full_name: str) -> Repository:
+    """Look up each GitHub repository only once per client."""
+    return gh.get_repo(full_name)
+
+
 def nixpkgs_repository(directory: str, remotes: dict[str, Remote]) -> Repo:
     info("Updating nixpkgs repository.")
     if os.path.exists(directory):
         repo = Repo(directory)
     else:
-        repo = Repo.init(directory, mkdir=True)
+        # Promotion only moves refs, so no working tree is needed.
+        repo = Repo.init(directory, mkdir=True, bare=True)
 
     for name, remote in remotes.items():
         info(f"Updating nixpkgs repository remote `{name}`.")
@@ -40,10 +51,13 @@ def nixpkgs_repository(directory: str, remotes: dict[str, Remote]) -> Repo:
         if name not in repo.remotes:
             repo.create_remote(name, remote.url)
 
-        for branch in remote.branches:
+        for branch in outdated_branches(repo, name, remote.branches):
             info(
                 f"Fetching nixpkgs repository remote `{name}` - branch `{branch}`."
             )
+            # Moving refs does not need any blobs. Do not limit the depth:
+            # the directory may be an older full checkout that is also used
+            # for rebasing, and a shallow repository cannot push reliably.
             getattr(repo.remotes, name).fetch(
                 refspec=branch, filter="blob:none"
             )
@@ -61,16 +75,17 @@ def check_nixpkgs_up_to_date(
     matrix_hookshot: MatrixHookshot,
 ):
     fc_nixos_repo = Repo(fc_nixos_dir)
-    versions_json_path = Path(fc_nixos_dir) / "release" / "versions.json"
 
     # HEAD = the head of the merged PR (before merge)
     # XXX: This makes an assumption that the PR only contains 1 commit. This should be cleaned up.
-    merge_base = fc_nixos_repo.git.rev_parse("HEAD^")
+    merge_base = fc_nixos_repo.head.commit.parents[0].hexsha
     # The integration branch is directly branched of the target branch, so we can only have one merge base.
-    fc_nixos_repo.git.switch(merge_base, detach=True)
-
-    with open(versions_json_path) as f:
-        versions = json.load(f)
+    # Only read versions.json from it instead of checking out the whole tree.
+    versions = json.loads(
+        fc_nixos_repo.git.show(
+            f"{merge_base}:release/versions.json", stdout_as_string=False
+        )
+    )
     previous_versions_rev = versions["nixpkgs"]["rev"]
 
     current_fc_nixos_commit = nixpkgs_repo.refs[
@@ -93,53 +108,129 @@ Please resolve manually by looking at the changes in nixpkgs between these commi
 
 
 def promote_nixpkgs(
-    gh: Github, nixpkgs_repo: Repo, target_branch: str, integration_branch: str
+    nixpkgs_repo: Repo, target_branch: str, integration_branch: str
 ) -> bool:
     """Promote nixpkgs repo target branch (e.g. nixos-24.05) to the integration branch
-    via a hard reset.
+    by moving the branch ref, without touching a working tree.
     First, check that the previous versions.json in fc-nixos is equivalent to the
     Returns: True when successful, False when unsuccessful.
     """
-    info("Hard reset nixpkgs target branch to integration branch.")
-    if nixpkgs_repo.is_dirty():
-        raise Exception("Repository is dirty!")
-
-    nixpkgs_repo.git.checkout(target_branch)
+    info("Reset nixpkgs target branch to integration branch.")
+    if not nixpkgs_repo.bare:
+        # Older checkouts have a working tree. Detach it from the branch, so
+        # moving the branch below does not make the working tree dirty.
+        nixpkgs_repo.git.checkout(detach=True)
 
-    nixpkgs_repo.git.reset(f"origin/{integration_branch}", hard=True)
-
-    nixpkgs_repo.git.push(force_with_lease=True)
+    nixpkgs_repo.git.update_ref(
+        f"refs/heads/{target_branch}", f"origin/{integration_branch}"
+    )
     # Tag result so that the commit is always referenced so that other release tooling can find it.
-    nixpkgs_repo.git.tag(integration_branch, message=integration_branch)
-    nixpkgs_repo.git.push("origin", tags=True)
-    gh.get_repo(NIXPKGS_REPO).get_git_ref(
-        f"heads/{integration_branch}"
-    ).delete()
+    nixpkgs_repo.git.tag(
+        integration_branch,
+        f"refs/heads/{target_branch}",
+        message=integration_branch,
+    )
+    # Update the branch, add the tag and delete the integration branch in a
+    # single push. Either all of them succeed or none does.
+    nixpkgs_repo.git.push(
+        "--atomic",
+        f"--force-with-lease=refs/heads/{target_branch}",
+        "origin",
+        f"refs/heads/{target_branch}:refs/heads/{target_branch}",
+        f"refs/tags/{integration_branch}:refs/tags/{integration_branch}",
+        f":refs/heads/{integration_branch}",
+    )
     return True
 
 
+def comment_and_delete_refs(
+    gh: Github, pr: PullRequest, comment: str, refs: list[GitRef]
+):
+    """Comment on the PR and delete all refs with a single GraphQL request.
+
+    The comment comes first, so it is posted even if deletions fail. A ref
+    that cannot be deleted (e.g. because it is already gone) does not stop
+    the others from being deleted and is only logged.
+    """
+    if refs:
+        info(f"Deleting {', '.join(ref.ref for ref in refs)}.")
+    params = ["$pr: ID!", "$comment: String!"]
+    mutations = [
+        "  comment: addComment(input: {subjectId: $pr, body: $comment}) "
+        "{ clientMutationId }"
+    ]
+    variables = {"pr": pr.node_id, "comment": comment}
+    for i, ref in enumerate(refs):
+        params.append(f"$ref{i}: ID!")
+        mutations.append(
+            f"  delete{i}: deleteRef(input: {{refId: $ref{i}}}) {{ clientMutationId }}"
+        )
+        variables[f"ref{i}"] = ref.node_id
+    # `graphql_query` raises on any error, even if the other fields were
+    # applied, so look at the errors of each field here instead.
+    _, data = gh.requester.requestJsonAndCheck(
+        "POST",
+        gh.requester.graphql_url,
+        input={
+            "query": f"mutation CleanupRefs({', '.join(params)}) {{\n"
+            + "\n".join(mutations)
+            + "\n}",
+            "variables": variables,
+        },
+    )
+    for error in data.get("errors", []):
+        path = error.get("path") or [""]
+        if path[0] == "comment":
+            raise RuntimeError(
+                f"Could not comment on PR #{pr.number}: {error.get('message')}"
+            )
+        i = path[0].removeprefix("delete")
+        ref = refs[int(i)].ref if i.isdigit() else "?"
+        warning(f"Could not delete {ref}: {error.get('message')}")
+
+
 def cleanup_old_prs_and_branches(
-    gh: Github, merged_integration_branch: str, platform_branch: str
+    gh: Github,
+    merged_pr: PullRequest,
+    comment: str,
+    merged_integration_branch: str,
+    platform_branch: str,
 ):
     info("Cleaning up old PRs and branches.")
-    fc_nixos_repo = gh.get_repo(FC_NIXOS_REPO)
-    nixpkgs_repo = gh.get_repo(NIXPKGS_REPO)
     merged_integration_branch_date = datetime.date.fromisoformat(
         merged_integration_branch.split("/")[2]
     )
-    # branches will be closed automatically by GitHub, when the branch is deleted
-    for repo in [fc_nixos_repo, nixpkgs_repo]:
-        for branch in repo.get_branches():
-            if not branch.name.startswith(
-                f"nixpkgs-auto-update/{platform_branch}/"
-            ):
+
+    def stale_branches(repo: Repository) -> list[GitRef]:
+        # Only list the refs of this platform's integration branches
+        # instead of paging through all branches of the repository.
+        prefix = f"heads/nixpkgs-auto-update/{platform_branch}"
+        res = []
+        for ref in repo.get_git_matching_refs(prefix):
+            # matching is by prefix, so this also lists e.g. fc-24.11-dev2
+            if not ref.ref.startswith(f"refs/{prefix}/"):
                 continue
-            branch_datestr = branch.name.split("/")[2]
+            branch_datestr = ref.ref.split("/")[4]
             if (
                 datetime.date.fromisoformat(branch_datestr)
                 < merged_integration_branch_date
             ):
-                repo.get_git_ref(f"heads/{branch.name}").delete()
+                res.append(ref)
+        return res
+
+    # list both repositories at the same time
+    repos = [get_repo(gh, FC_NIXOS_REPO), get_repo(gh, NIXPKGS_REPO)]
+    stale = []
+    try:
+        with ThreadPoolExecutor() as pool:
+            stale = [
+                ref for refs in pool.map(stale_branches, repos) for ref in refs
+            ]
+    finally:
+        # The promotion already happened, so post the comment even if the
+        # branches could not be listed. PRs will be closed automatically by
+        # GitHub, when the branch is deleted.
+        comment_and_delete_refs(gh, merged_pr, comment, stale)
 
 
 def run(
@@ -151,7 +242,7 @@ def run(
     matrix_hookshot_url: str,
 ):
     gh = Github(auth=Auth.Token(github_access_token))
-    fc_nixos_pr = gh.get_repo(FC_NIXOS_REPO).get_pull(int(merged_pr_id))
+    fc_nixos_pr = get_repo(gh, FC_NIXOS_REPO).get_pull(int(merged_pr_id))
     pr_platform_version = fc_nixos_pr.base.ref.split("-")[1]
     integration_branch = fc_nixos_pr.head.ref
     nixpkgs_target_branch = f"nixos-{pr_platform_version}"
@@ -178,12 +269,11 @@ def run(
             "Abort promotion of nixpkgs branch. PR is not up to date."
         )
         return
-    if promote_nixpkgs(
-        gh, nixpkgs_repo, nixpkgs_target_branch, integration_branch
-    ):
-        fc_nixos_pr.create_issue_comment(
-            f"Promoted this nixpkgs integration branch to the `{nixpkgs_target_branch}` branch successfully."
-        )
+    if promote_nixpkgs(nixpkgs_repo, nixpkgs_target_branch, integration_branch):
         cleanup_old_prs_and_branches(
-            gh, integration_branch, fc_nixos_pr.base.ref
+            gh,
+            fc_nixos_pr,
+            f"Promoted this nixpkgs integration branch to the `{nixpkgs_target_branch}` branch successfully.",
+            integration_branch,
+            fc_nixos_pr.base.ref,
         )
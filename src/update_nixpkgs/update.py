@@ -17,11 +17,9 @@ Manual merges work by pushing manually in the nixpkgs integration branch and run
 """
 import datetime
 import logging
-import os
 import sys
 from dataclasses import dataclass
 from os import path
-from pathlib import Path
 from subprocess import check_output
 
 from git import Commit, Repo
@@ -56,6 +54,27 @@ class Remote:
     branches: list[str]
 
 
+def outdated_branches(
+    repo: Repo, remote: str, branches: list[str]
+) -> list[str]:
+    """Return the branches whose tip on `remote` differs from the local
+    remote-tracking branch. Branches that do not exist on the remote are
+    left out."""
+    remote_tips = {}
+    for line in repo.git.ls_remote("--heads", remote, *branches).splitlines():
+        sha, _, ref = line.partition("\t")
+        remote_tips[ref.removeprefix("refs/heads/")] = sha
+    local_tips = {
+        ref.remote_head: ref.object.hexsha for ref in repo.remotes[remote].refs
+    }
+    return [
+        branch
+        for branch in branches
+        if branch in remote_tips
+        and local_tips.get(branch) != remote_tips[branch]
+    ]
+
+
 def nixpkgs_repository(directory: str, remotes: dict[str, Remote]) -> Repo:
     logging.info("Updating nixpkgs repository.")
     if path.exists(directory):
@@ -70,7 +89,25 @@ def nixpkgs_repository(directory: str, remotes: dict[str, Remote]) -> Repo:
         if name not in repo.remotes:
             repo.create_remote(name, remote.url)
 
-        for branch in remote.branches:
+        # Checking the remote tips first is cheap compared to a fetch
+        # negotiation on nixpkgs, and on most days nothing has changed.
+        branches = outdated_branches(repo, name, remote.branches)
+        if not branches:
+            logging.info(f"nixpkgs repository remote `{name}` is up to date.")
+            continue
+        logging.info(
+            f"Fetching nixpkgs repository remote `{name}` - branches {branches}."
+        )
+        try:
+            getattr(repo.remotes, name).fetch(
+                refspec=branches, filter="blob:none"
+            )
+            continue
+        except GitCommandError as e:
+            logging.debug("Error while fetching branches: %s", e)
+
+        # A branch vanished in the meantime, fetch them one by one instead.
+        for branch in branches:
             logging.info(
                 f"Fetching nixpkgs repository remote `{name}` - branch `{branch}`."
             )
@@ -80,7 +117,7 @@ def nixpkgs_repository(directory: str, remotes: dict[str, Remote]) -> Repo:
                     refspec=branch, filter="blob:none"
                 )
             except GitCommandError as e:
-                logging.debug("Error while fetching branch ", e)
+                logging.debug("Error while fetching branch: %s", e)
                 pass
 
     return repo
@@ -98,9 +135,12 @@ def rebase_nixpkgs(
     if nixpkgs_repo.is_dirty():
         raise Exception("Repository is dirty!")
 
-    if not any(
-        f"origin/{integration_branch}" == ref.name for ref in nixpkgs_repo.refs
-    ):
+    # `Repo.refs` reads all refs from disk again on every access. Only the
+    # remote-tracking refs are looked up here and the rebase does not move
+    # them, so read them once.
+    refs = {ref.name: ref for ref in nixpkgs_repo.refs}
+
+    if f"origin/{integration_branch}" not in refs:
         logging.info("Creating new integration branch")
         tracking_branch = nixpkgs_repo.create_head(
             integration_branch, f"origin/{branch_to_rebase}"
@@ -110,10 +150,8 @@ def rebase_nixpkgs(
         logging.info("Checking out existing integration branch")
         nixpkgs_repo.git.checkout(integration_branch)
 
-    latest_upstream = nixpkgs_repo.refs[f"upstream/{branch_to_rebase}"].commit
-    common_grounds = nixpkgs_repo.merge_base(
-        f"upstream/{branch_to_rebase}", "HEAD"
-    )
+    latest_upstream = refs[f"upstream/{branch_to_rebase}"].commit
+    common_grounds = nixpkgs_repo.merge_base(latest_upstream, "HEAD")
 
     if (
         all(
@@ -146,7 +184,7 @@ git push origin {integration_branch}
             sys.exit(1)
 
         # Check if there are new commits compared to the last day's integration branch.
-        if f"origin/{last_day_integration_branch}" in nixpkgs_repo.refs:
+        if f"origin/{last_day_integration_branch}" in refs:
             diff_index = nixpkgs_repo.git.diff_index(
                 f"origin/{last_day_integration_branch}"
             )
@@ -161,7 +199,7 @@ git push origin {integration_branch}
 
         return NixpkgsRebaseResult(
             upstream_commit=latest_upstream,
-            fork_commit=nixpkgs_repo.refs[f"origin/{branch_to_rebase}"].commit,
+            fork_commit=refs[f"origin/{branch_to_rebase}"].commit,
             fork_before_rebase=current_state,
             fork_after_rebase=nixpkgs_repo.head.commit,
         )
@@ -177,9 +215,7 @@ def update_fc_nixos(
     new_hex_sha: str,
 ):
     logging.info("Update fc-nixos.")
-    original_workdir = Path.cwd()
-    os.chdir(original_workdir / fc_nixos_dir)
-    repo = Repo(Path.cwd())
+    repo = Repo(fc_nixos_dir)
     if not any(integration_branch == head.name for head in repo.heads):
         tracking_branch = repo.create_head(
             integration_branch, f"origin/{target_branch}"
@@ -196,10 +232,11 @@ def update_fc_nixos(
             "--override-input",
             "nixpkgs",
             f"github:{NIXPKGS_REPO}/{new_hex_sha}",
-        ]
+        ],
+        cwd=fc_nixos_dir,
     )
-    check_output(["nix", "run", ".#buildVersionsJson"]).decode("utf-8")
-    check_output(["nix", "run", ".#buildPackageVersionsJson"]).decode("utf-8")
+    check_output(["nix", "run", ".#buildVersionsJson"], cwd=fc_nixos_dir)
+    check_output(["nix", "run", ".#buildPackageVersionsJson"], cwd=fc_nixos_dir)
 
     repo.git.add(
         [
@@ -210,18 +247,16 @@ def update_fc_nixos(
     )
     repo.git.commit(message=f"Auto update nixpkgs to {new_hex_sha}")
     repo.git.push("origin", integration_branch, force=True)
-    os.chdir(original_workdir)
 
 
 def create_fc_nixos_pr(
     platform_version: str,
     target_branch: str,
     integration_branch: str,
-    github_access_token: str,
+    gh: Github,
     now: str,
 ):
     logging.info("Create PR in fc-nixos.")
-    gh = Github(auth=Auth.Token(github_access_token))
     fc_nixos_repo = gh.get_repo(FC_NIXOS_REPO)
     # XXX: Currently deactivated, as there is a bug in the GH REST API so that no result is returned
     # If there is an open PR for this integration branch, don't create a new one.
@@ -257,32 +292,41 @@ def run(
     matrix_hookshot_url: str,
 ):
     matrix_hookshot = MatrixHookshot(matrix_hookshot_url)
+    # One client for all platforms, so its HTTPS connection is reused.
+    gh = Github(auth=Auth.Token(github_access_token))
     today = datetime.date.today().isoformat()
     yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
 
+    def integration_branches(platform_version: str) -> tuple[str, str]:
+        fc_nixos_target_branch = f"fc-{platform_version}-dev"
+        return (
+            f"nixpkgs-auto-update/{fc_nixos_target_branch}/{today}",
+            f"nixpkgs-auto-update/{fc_nixos_target_branch}/{yesterday}",
+        )
+
+    # Fetch the branches of all platform versions up front, with one fetch
+    # per remote.
+    remotes = {
+        "upstream": Remote(nixpkgs_upstream_url, []),
+        "origin": Remote(nixpkgs_origin_url, []),
+    }
+    for platform_version in platform_versions:
+        nixpkgs_target_branch = f"nixos-{platform_version}"
+        remotes["upstream"].branches.append(nixpkgs_target_branch)
+        remotes["origin"].branches += [
+            nixpkgs_target_branch,
+            *integration_branches(platform_version),
+        ]
+    nixpkgs_repo = nixpkgs_repository(nixpkgs_dir, remotes)
+
     for platform_version in platform_versions:
         logging.info(f"Updating platform {platform_version}")
         nixpkgs_target_branch = f"nixos-{platform_version}"
         fc_nixos_target_branch = f"fc-{platform_version}-dev"
-        integration_branch = (
-            f"nixpkgs-auto-update/{fc_nixos_target_branch}/{today}"
-        )
-        last_day_integration_branch = (
-            f"nixpkgs-auto-update/{fc_nixos_target_branch}/{yesterday}"
+        integration_branch, last_day_integration_branch = integration_branches(
+            platform_version
         )
 
-        remotes = {
-            "upstream": Remote(nixpkgs_upstream_url, [nixpkgs_target_branch]),
-            "origin": Remote(
-                nixpkgs_origin_url,
-                [
-                    nixpkgs_target_branch,
-                    integration_branch,
-                    last_day_integration_branch,
-                ],
-            ),
-        }
-        nixpkgs_repo = nixpkgs_repository(nixpkgs_dir, remotes)
         if result := rebase_nixpkgs(
             nixpkgs_repo,
             nixpkgs_target_branch,
@@ -305,6 +349,6 @@ def run(
                 platform_version,
                 fc_nixos_target_branch,
                 integration_branch,
-                github_access_token,
+                gh,
                 today,
             )
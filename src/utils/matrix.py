@@ -1,11 +1,24 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 
 class MatrixHookshot:
     def __init__(self, hookshot_url):
         self.hookshot_url = hookshot_url
+        # Keep the connection alive between notifications. Only retry when
+        # the connection could not be established. A read error may happen
+        # after the hookshot accepted the message, so retrying it could post
+        # the message twice.
+        self._session = requests.Session()
+        self._session.mount(
+            "https://",
+            HTTPAdapter(
+                max_retries=Retry(total=3, connect=3, read=False, status=0)
+            ),
+        )
 
     def send_notification(self, message: str):
-        requests.put(
-            self.hookshot_url, json={"text": message}
+        self._session.put(
+            self.hookshot_url, json={"text": message}, timeout=10
         ).raise_for_status()